@@ -1,78 +1,341 @@
-import requests, time, os, sys
+import aiohttp, asyncio, logging, orjson, os, random, sys, time
+from datetime import date, datetime, timedelta
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
 from dotenv import load_dotenv
-from db import init_schema, upsert_repo, dump_to_csv
+from db import init_schema, bulk_upsert, load_known_repos, pooled_connection, dump_to_csv
 
 load_dotenv()
+logging.basicConfig(level=os.environ.get("CRAWL_LOG", "INFO"), format="%(asctime)s %(levelname)s %(message)s")
+log = logging.getLogger("crawler")
+
 GITHUB_GRAPHQL = "https://api.github.com/graphql"
+MAX_RETRIES = 5
+MAX_CONCURRENCY = 8
+BATCH_SIZE = 8
+SEARCH_RESULT_CAP = 1000
+KNOWN_CACHE_SIZE = 200_000
+FLUSH_SIZE = 500
+# points that MAX_CONCURRENCY batches of BATCH_SIZE searches can spend between rateLimit reads
+RATE_LIMIT_RESERVE = MAX_CONCURRENCY * BATCH_SIZE
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+class TokenBucket:
+    """Client-side budget of GitHub GraphQL points, refilled continuously."""
+
+    def __init__(self, capacity=5000, refill_rate=5000 / 3600):
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self.tokens = capacity
+        self.last_cost = 1
+        self.reset_at = None
+        self.updated = time.monotonic()
+
+    async def acquire(self, cost=None):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.refill_rate)
+        self.updated = now
+        # reserve first, then wait out any deficit, so concurrent callers queue fairly
+        self.tokens -= self.last_cost if cost is None else cost
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.refill_rate)
+
+_bucket = TokenBucket()
+
+def backoff(attempt):
+    return min(60, 2 ** attempt) * random.uniform(0.5, 1.5)
+
+@lru_cache(maxsize=8)
+def _parse_reset(reset_at):
+    return datetime.fromisoformat(reset_at.replace("Z", "+00:00")).timestamp()
+
+def reset_wait(reset_at):
+    """Seconds until the rate-limit window resetting at `reset_at` (ISO 8601) opens again."""
+    return max(0, _parse_reset(reset_at) - time.time()) + 1
+
+def retry_wait(headers, attempt):
+    """Seconds to wait before retrying a throttled or failed response."""
+    retry_after = headers.get("Retry-After")
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            try:
+                return max(0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    reset = headers.get("x-ratelimit-reset")
+    if headers.get("x-ratelimit-remaining") == "0" and reset and reset.isdigit():
+        return max(0, int(reset) - time.time()) + 1
+    return backoff(attempt)
+
+def is_throttled(status, headers):
+    if status in RETRY_STATUSES:
+        return True
+    # secondary limits come back as 403 with Retry-After or an exhausted primary budget
+    return status == 403 and ("Retry-After" in headers or headers.get("x-ratelimit-remaining") == "0")
+
+def is_rate_limited(errors):
+    return any(e.get("type") == "RATE_LIMITED" for e in errors)
+
+async def wait_for_reset():
+    # a RATE_LIMITED response carries no rateLimit block; use the last resetAt seen
+    wait_for = reset_wait(_bucket.reset_at) if _bucket.reset_at else 60
+    log.warning("⏳ Rate limited. Sleeping for %.0f seconds...", wait_for)
+    await asyncio.sleep(wait_for)
+
+async def graphql_post(session, payload):
+    body = orjson.dumps(payload)
+    for attempt in range(MAX_RETRIES):
+        await _bucket.acquire()
+        try:
+            async with session.post(GITHUB_GRAPHQL, data=body) as r:
+                if is_throttled(r.status, r.headers):
+                    wait = retry_wait(r.headers, attempt)
+                    log.warning("⚠️ HTTP %d. Retrying in %.1f seconds...", r.status, wait)
+                elif r.status >= 400:
+                    # bad token, bad request, etc.: retrying will not help
+                    raise RuntimeError(f"GitHub API returned HTTP {r.status}: {(await r.text())[:200]}")
+                else:
+                    data = orjson.loads(await r.read())
+                    rate = (data.get("data") or {}).get("rateLimit") or {}
+                    if rate.get("cost"):
+                        _bucket.last_cost = rate["cost"]
+                    if rate.get("resetAt"):
+                        _bucket.reset_at = rate["resetAt"]
+                    return data
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            wait = backoff(attempt)
+            log.warning("⚠️ Request failed (%s). Retrying in %.1f seconds...", e, wait)
+        await asyncio.sleep(wait)
+    raise RuntimeError(f"GitHub API unreachable after {MAX_RETRIES} attempts")
+
+SEARCH_FIELDS = """
+fragment Fields on SearchResultItemConnection {
+  pageInfo { endCursor hasNextPage }
+  nodes {
+    ... on Repository {
+      id
+      name
+      owner { login }
+      stargazerCount
+      createdAt
+    }
+  }
+}
+"""
+
+@lru_cache(maxsize=BATCH_SIZE)
+def _batched_document(n):
+    params = ", ".join(f"$q{i}: String!, $c{i}: String" for i in range(n))
+    fields = "\n  ".join(
+        f"w{i}: search(query: $q{i}, type: REPOSITORY, first: 100, after: $c{i}) {{ ...Fields }}" for i in range(n))
+    return "query SearchBatch(%s) {\n  %s\n  rateLimit { cost remaining resetAt }\n}\n%s" % (
+        params, fields, SEARCH_FIELDS)
+
+def build_batched_query(partitions):
+    """Build one aliased search document (w0, w1, ...) for a list of (query, cursor) pairs.
+
+    The document depends only on the number of partitions, so it is built once per size and
+    every request sends identical text with the values in variables.
+    """
+    variables = {}
+    for i, (query, cursor) in enumerate(partitions):
+        variables[f"q{i}"] = query
+        variables[f"c{i}"] = cursor
+    return _batched_document(len(partitions)), variables
+
+def parse_repo_node(node):
+    """Return (repo_id, name, owner, stars, created_at), the column order bulk_upsert writes."""
+    g = node.get
+    return (g("id"), g("name"), g("owner")["login"], g("stargazerCount"), g("createdAt"))
 
-def run_crawl(query, max_repos=1000):
-    headers = {"Authorization": f"bearer {os.environ['GITHUB_TOKEN']}"}
-    cursor, fetched = None, 0
-
-    while fetched < max_repos:
-        q = f"""
-        query {{
-          search(query: "{query}", type: REPOSITORY, first: 100, after: {('"%s"' % cursor) if cursor else 'null'}) {{
-            pageInfo {{ endCursor hasNextPage }}
-            nodes {{
-              ... on Repository {{
-                id
-                name
-                owner {{ login }}
-                stargazerCount
-                url
-                createdAt
-                updatedAt
-              }}
-            }}
-          }}
-          rateLimit {{ remaining resetAt }}
-        }}
-        """
-
-        r = requests.post(GITHUB_GRAPHQL, headers=headers, json={"query": q})
-        data = r.json()
-
-        if "errors" in data:
-            print("❌ GitHub API error:", data["errors"])
-            time.sleep(5)
+def changed_rows(rows, known):
+    """Drop rows whose (name, owner, stars) match `known`, recording the rest; `known` is
+    kept as an LRU. Only the last row per repo_id is kept, so a flush never repeats a repo."""
+    latest = {}
+    for row in rows:
+        latest[row[0]] = row
+    changed = []
+    for repo_id, row in latest.items():
+        value = row[1:4]
+        if known.pop(repo_id, None) != value:
+            changed.append(row)
+        known[repo_id] = value
+    while len(known) > KNOWN_CACHE_SIZE:
+        del known[next(iter(known))]
+    return changed
+
+async def crawl_batch(session, queries, queue, max_repos=SEARCH_RESULT_CAP):
+    """Page through several search queries together, one aliased request per round-trip,
+    handing parsed rows to the writer through `queue`."""
+    states = [{"query": q, "cursor": None, "fetched": 0, "failures": 0} for q in queries]
+    active = list(states)
+
+    while active:
+        doc, variables = build_batched_query([(s["query"], s["cursor"]) for s in active])
+        data = await graphql_post(session, {"query": doc, "operationName": "SearchBatch", "variables": variables})
+        errors = data.get("errors") or []
+        results = data.get("data") or {}
+
+        if is_rate_limited(errors):
+            await wait_for_reset()
             continue
+        if errors:
+            log.error("❌ GitHub API error: %s", errors)
+
+        # aliases that errored come back null; keep only those for another attempt
+        still_active, progressed = [], False
+        for i, state in enumerate(active):
+            search_data = results.get(f"w{i}")
+            if search_data is None:
+                state["failures"] += 1
+                if state["failures"] > MAX_RETRIES:
+                    log.error("❌ Giving up on %s after %d failed attempts", state["query"], state["failures"])
+                else:
+                    still_active.append(state)
+                continue
+            state["failures"] = 0
+            progressed = True
+
+            for node in search_data.get("nodes", []):
+                await queue.put(parse_repo_node(node))
+                state["fetched"] += 1
+                if state["fetched"] >= max_repos:
+                    break
+
+            page_info = search_data.get("pageInfo", {})
+            if page_info.get("hasNextPage") and state["fetched"] < max_repos:
+                state["cursor"] = page_info.get("endCursor")
+                still_active.append(state)
+            else:
+                log.info("✅ Crawled %d repositories for: %s", state["fetched"], state["query"])
+        active = still_active
+
+        limit = results.get("rateLimit") or {}
+        if active and limit.get("remaining", RATE_LIMIT_RESERVE) < RATE_LIMIT_RESERVE:
+            wait_for = reset_wait(limit["resetAt"])
+            log.warning("⏳ Rate limited. Sleeping for %.0f seconds...", wait_for)
+            await asyncio.sleep(wait_for)
+        elif active and not progressed:
+            await asyncio.sleep(backoff(max(s["failures"] for s in active)))
+
+    return sum(s["fetched"] for s in states)
+
+def _write(conn, rows):
+    bulk_upsert(conn, rows)
+    conn.commit()
 
-        limit = data.get("data", {}).get("rateLimit", {})
-        if limit and limit.get("remaining", 1) < 5:
-            wait_for = 60
-            print(f"⏳ Rate limited. Sleeping for {wait_for} seconds...")
-            time.sleep(wait_for)
+async def write_rows(queue, known):
+    """Drain rows from `queue` into Postgres, up to FLUSH_SIZE per transaction, until None.
+
+    Writes run in a worker thread on one pooled connection, so the next GitHub requests
+    stay in flight while Postgres commits.
+    """
+    done = False
+    with pooled_connection() as conn:
+        while not done:
+            batch = [await queue.get()]
+            while len(batch) < FLUSH_SIZE and not queue.empty():
+                batch.append(queue.get_nowait())
+            if batch[-1] is None:
+                done = True
+                batch.pop()
+            rows = changed_rows(batch, known)
+            if rows:
+                await asyncio.to_thread(_write, conn, rows)
+
+COUNT_QUERY = "query PartitionCount($q: String!) { search(query: $q, type: REPOSITORY, first: 1) { repositoryCount } }"
+
+async def fetch_partition_count(session, query):
+    while True:
+        data = await graphql_post(session, {"query": COUNT_QUERY, "operationName": "PartitionCount", "variables": {"q": query}})
+        errors = data.get("errors") or []
+        if is_rate_limited(errors):
+            await wait_for_reset()
             continue
+        if errors:
+            raise RuntimeError(f"GitHub API error: {errors}")
+        return data["data"]["search"]["repositoryCount"]
+
+def date_windows(start, end, days):
+    """Split the inclusive range start..end into consecutive windows of at most `days` days."""
+    windows = []
+    while start <= end:
+        stop = min(end, start + timedelta(days=days - 1))
+        windows.append((start, stop))
+        start = stop + timedelta(days=1)
+    return windows
+
+def window_query(base_query, start, end):
+    return f"{base_query} created:{start.isoformat()}..{end.isoformat()}"
+
+async def partition_queries(session, base_query, start, end):
+    """Split a search into created: windows that each stay under GitHub's 1000-result cap.
+
+    Every week is probed concurrently, and any window over the cap is bisected (both halves
+    probed concurrently) until it fits or is a single day. Empty windows are dropped. At most
+    MAX_CONCURRENCY probes are in flight at once.
+    """
+    sem = asyncio.Semaphore(MAX_CONCURRENCY)
+
+    async def split(start, end):
+        query = window_query(base_query, start, end)
+        async with sem:
+            count = await fetch_partition_count(session, query)
+        if not count:
+            return []
+        if count <= SEARCH_RESULT_CAP:
+            return [query]
+        if start == end:
+            log.warning("⚠️ %d results for %s; only the first %d are reachable", count, query, SEARCH_RESULT_CAP)
+            return [query]
+        mid = start + (end - start) // 2
+        halves = await asyncio.gather(split(start, mid), split(mid + timedelta(days=1), end))
+        return halves[0] + halves[1]
+
+    weeks = await asyncio.gather(*(split(a, b) for a, b in date_windows(start, end, 7)))
+    partitions = [query for week in weeks for query in week]
+    log.info("🧩 Split into %d partitions", len(partitions))
+    return partitions
 
-        search_data = data.get("data", {}).get("search", {})
-        nodes = search_data.get("nodes", [])
+async def crawl_all(base_query, start, end, max_repos=SEARCH_RESULT_CAP):
+    """Partition a search by creation date, then crawl the partitions in aliased batches
+    running concurrently over one HTTP session, with a single writer storing the results."""
+    headers = {
+        "Authorization": f"bearer {os.environ['GITHUB_TOKEN']}",
+        "Content-Type": "application/json",
+    }
+    sem = asyncio.Semaphore(MAX_CONCURRENCY)
+    # repositories unchanged since the last crawl are not rewritten
+    known = load_known_repos(KNOWN_CACHE_SIZE)
 
-        for node in nodes:
-            upsert_repo(
-                node["id"],
-                node["name"],
-                node["owner"]["login"],
-                node["stargazerCount"]
-            )
-            print(f"✅ Crawled {fetched} repositories")
-            fetched += 1
-            if fetched >= max_repos:
-                break
+    queue = asyncio.Queue(maxsize=FLUSH_SIZE)
 
-        page_info = search_data.get("pageInfo", {})
-        if not page_info.get("hasNextPage"):
-            break
+    async def bounded(session, batch):
+        async with sem:
+            return await crawl_batch(session, batch, queue, max_repos)
 
-        cursor = page_info.get("endCursor")
+    async def produce(session, batches):
+        counts = await asyncio.gather(*(bounded(session, b) for b in batches))
+        await queue.put(None)
+        return sum(counts)
 
-    print(f"✅ Crawled {fetched} repositories")
+    # keep connections (and their TLS sessions) alive across the whole crawl
+    connector = aiohttp.TCPConnector(limit=16, keepalive_timeout=60, ttl_dns_cache=300)
+    # per-socket limits, so time spent queued for a pooled connection does not count
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=30)
+    async with aiohttp.ClientSession(connector=connector, headers=headers, timeout=timeout) as session:
+        queries = await partition_queries(session, base_query, start, end)
+        batches = [queries[i:i + BATCH_SIZE] for i in range(0, len(queries), BATCH_SIZE)]
+        total, _ = await asyncio.gather(produce(session, batches), write_rows(queue, known))
+    log.info("✅ Crawled %d repositories", total)
 
 if __name__ == "__main__":
-    print("🚀 Initializing database schema...")
+    log.info("🚀 Initializing database schema...")
     init_schema()
-    print("🔍 Starting GitHub crawl...")
-    run_crawl("stars:>100 language:Python created:2023-01-01..2023-12-31", max_repos=10)
-    print("📦 Dumping data to CSV...")
+    log.info("🔍 Starting GitHub crawl...")
+    asyncio.run(crawl_all("stars:>100 language:Python", date(2023, 1, 1), date(2023, 12, 31)))
+    log.info("📦 Dumping data to CSV...")
     dump_to_csv()
-    print("🎉 Done!")
+    log.info("🎉 Done!")
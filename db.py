@@ -1,35 +1,92 @@
-import psycopg2
-import pandas as pd
+import csv
+import io
+import logging
+from contextlib import contextmanager
 from datetime import datetime
+from functools import lru_cache
+from pathlib import Path
+from psycopg2.pool import ThreadedConnectionPool
 
-def get_connection():
-    import os
-    return psycopg2.connect(os.environ["DATABASE_URL"])
+log = logging.getLogger("db")
+_pool = None
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        import os
+        _pool = ThreadedConnectionPool(1, 8, os.environ["DATABASE_URL"])
+    return _pool
+
+@contextmanager
+def pooled_connection():
+    pool = _get_pool()
+    conn = pool.getconn()
+    try:
+        yield conn
+    finally:
+        pool.putconn(conn)
+
+@lru_cache(maxsize=1)
+def _load_schema():
+    return (Path(__file__).parent / "schema.sql").read_text(encoding="utf-8")
 
 def init_schema():
-    conn = get_connection()
-    with conn, conn.cursor() as cur:
-        cur.execute(open("schema.sql").read())
-    conn.close()
-
-def upsert_repo(repo_id, name, owner, stars):
-    conn = get_connection()
-    with conn, conn.cursor() as cur:
-        cur.execute("""
-        INSERT INTO repositories (repo_id, name, owner, stars, updated_at)
-        VALUES (%s, %s, %s, %s, %s)
-        ON CONFLICT (repo_id)
-        DO UPDATE SET stars = EXCLUDED.stars, updated_at = EXCLUDED.updated_at;
-        """, (repo_id, name, owner, stars, datetime.utcnow()))
+    with pooled_connection() as conn:
+        with conn, conn.cursor() as cur:
+            cur.execute(_load_schema())
+        # surface migration warnings raised by schema.sql
+        for notice in conn.notices:
+            log.warning(notice.strip())
+        del conn.notices[:]
+
+def bulk_upsert(conn, repos):
+    """Stage and merge `repos` on `conn`; the caller owns the transaction and commits.
+
+    `repos` must hold at most one row per repo_id: a single INSERT ... ON CONFLICT cannot
+    touch the same row twice.
+    """
+    if not repos:
+        return
+    now = datetime.utcnow()
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for repo_id, name, owner, stars, created_at in repos:
+        writer.writerow((repo_id, name, owner, stars, created_at, now))
+    buf.seek(0)
+    with conn.cursor() as cur:
+        cur.execute("CREATE TEMP TABLE IF NOT EXISTS repos_stage (LIKE repositories) ON COMMIT DELETE ROWS;")
+        cur.copy_expert("COPY repos_stage (repo_id, name, owner, stars, created_at, updated_at) FROM STDIN WITH CSV", buf)
+        # history first, while repositories still holds the previous stars: renames and
+        # transfers with an unchanged star count add no history row
         cur.execute("""
         INSERT INTO stars_history (repo_id, stars, collected_at)
-        VALUES (%s, %s, %s);
-        """, (repo_id, stars, datetime.utcnow()))
-    conn.commit()
-    conn.close()
+        SELECT s.repo_id, s.stars, s.updated_at
+        FROM repos_stage s LEFT JOIN repositories r USING (repo_id, created_at)
+        WHERE r.stars IS DISTINCT FROM s.stars;
+        """)
+        cur.execute("""
+        INSERT INTO repositories (repo_id, name, owner, stars, created_at, updated_at)
+        SELECT repo_id, name, owner, stars, created_at, updated_at FROM repos_stage
+        ON CONFLICT (repo_id, created_at)
+        DO UPDATE SET name = EXCLUDED.name, owner = EXCLUDED.owner,
+                      stars = EXCLUDED.stars, updated_at = EXCLUDED.updated_at;
+        """)
+
+def load_known_repos(limit):
+    """Map repo_id -> (name, owner, stars) for up to `limit` of the most recently updated
+    repositories."""
+    with pooled_connection() as conn:
+        with conn, conn.cursor() as cur:
+            # oldest first, so the caller's LRU evicts the stalest entries first
+            cur.execute("""
+            SELECT repo_id, name, owner, stars FROM (
+                SELECT repo_id, name, owner, stars, updated_at FROM repositories
+                ORDER BY updated_at DESC LIMIT %s
+            ) recent ORDER BY updated_at;
+            """, (limit,))
+            return {row[0]: row[1:] for row in cur.fetchall()}
 
 def dump_to_csv(filename="repos_dump.csv"):
-    conn = get_connection()
-    df = pd.read_sql("SELECT * FROM repositories;", conn)
-    df.to_csv(filename, index=False)
-    conn.close()
+    with pooled_connection() as conn:
+        with conn.cursor() as cur, open(filename, "w", newline="") as f:
+            cur.copy_expert("COPY (SELECT * FROM repositories) TO STDOUT WITH CSV HEADER", f)
@@ -1,10 +1,42 @@
+-- Databases created before repositories was partitioned have a plain table by that name:
+-- move it (and its primary-key index) aside so the partitioned table can take its place.
+-- Its rows have no created_at, so they cannot be placed in a partition; the table is kept
+-- as repositories_unpartitioned, never dropped, for the operator to migrate or discard.
+DO $$
+BEGIN
+    IF to_regclass('repositories') IS NOT NULL AND NOT EXISTS (
+        SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass('repositories')
+    ) THEN
+        ALTER TABLE repositories RENAME TO repositories_unpartitioned;
+        ALTER INDEX IF EXISTS repositories_pkey RENAME TO repositories_unpartitioned_pkey;
+        RAISE WARNING 'repositories was not partitioned: its rows were kept in repositories_unpartitioned';
+    END IF;
+END $$;
+
+-- Range-partitioned by creation date, mirroring the crawler's created: search windows,
+-- so each crawl window's upserts touch one partition and its (smaller) key index.
+-- Postgres requires the partition key in the primary key, so repo_id is NOT unique on its
+-- own: conflict targets must be (repo_id, created_at), never (repo_id) alone.
 CREATE TABLE IF NOT EXISTS repositories (
-    repo_id TEXT PRIMARY KEY,
+    repo_id TEXT,
     name TEXT,
     owner TEXT,
     stars INTEGER,
-    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-);
+    created_at TIMESTAMP NOT NULL,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (repo_id, created_at)
+) PARTITION BY RANGE (created_at);
+
+DO $$
+BEGIN
+    FOR y IN 2008..2030 LOOP
+        EXECUTE format(
+            'CREATE TABLE IF NOT EXISTS repositories_%s PARTITION OF repositories FOR VALUES FROM (%L) TO (%L)',
+            y, make_date(y, 1, 1), make_date(y + 1, 1, 1));
+    END LOOP;
+END $$;
+
+CREATE TABLE IF NOT EXISTS repositories_default PARTITION OF repositories DEFAULT;
 
 CREATE TABLE IF NOT EXISTS stars_history (
     repo_id TEXT,